@@ -2,8 +2,11 @@
 api_client.py
 A dedicated Gemini Vision API client module that:
 - Sends image and text prompts to the Gemini API (REST)
-- Retries up to `max_attempts` with exponential backoff
-- Minimal dependency: requests, PIL (for image encoding)
+- Retries up to `max_attempts` with exponential backoff (urllib3 Retry on the session)
+- Reuses one pooled requests.Session (HTTP keep-alive) across calls
+- Analyzes several images concurrently over that session (`analyze_many`)
+- Or analyzes several images in one multi-image request (`analyze_images_batch`)
+- Minimal dependency: requests, PIL (for image encoding); pybase64 and orjson are used when installed
 
 Environment variables expected:
     GEMINI_API_KEY        - required (for primary authentication)
@@ -11,20 +14,42 @@ Environment variables expected:
 
 Usage:
     from api_client import GeminiClient, APIError
-    client = GeminiClient(api_key="your_key")
-    try:
-        resp = client.analyze_image_from_buffer(image_buffer, model_name, system_prompt)
-    except APIError as e:
-        print("Analysis failed:", e)
+    with GeminiClient(api_key="your_key") as client:
+        try:
+            resp = client.analyze_image_from_bytes(image_bytes, model_name, system_prompt)
+        except APIError as e:
+            print("Analysis failed:", e)
 """
 
 import os
 import time
 import logging
+import threading
+import warnings
 import base64
-from typing import Any, Dict, Optional, IO
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, Optional, IO, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # SIMD-accelerated base64
+    import pybase64
+    _b64encode = pybase64.b64encode
+except ImportError:
+    _b64encode = base64.b64encode
+
+try:
+    import orjson
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+    _json_loads = json.loads
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("gemini_client")
@@ -32,96 +57,250 @@ logger = logging.getLogger("gemini_client")
 # --- Error Class ---
 
 class APIError(Exception):
-    """Raised when all attempts fail."""
-    pass
+    """Raised when all attempts fail.
+
+    `status` carries the HTTP status code of the failed response, if there was one.
+    """
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+# --- Rate Limiting ---
+
+class _TokenBucket:
+    """Thread-safe token bucket: `rate` requests per second, bursts of up to `capacity`.
+
+    Callers only sleep once the burst allowance is used up; tokens may go negative,
+    which reserves a slot so concurrent waiters are released in order.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+# --- Retry Policy ---
+
+class _BackoffRetry(Retry):
+    """urllib3 Retry whose first retry also waits.
+
+    urllib3 retries the first failure immediately and only then backs off
+    (`backoff_factor * 2 ** (n - 1)`); this waits `backoff_factor` before the
+    first retry too, so the waits are backoff_factor, 2x, 4x, ...
+    A Retry-After header still takes precedence.
+    """
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        if not backoff and self.history:
+            return self.backoff_factor
+        return backoff
 
 # --- Helper Functions ---
 
-def _encode_image_buffer(image_buffer: IO[bytes]) -> str:
-    """Read bytes from buffer and base64 encode them for the API payload."""
-    image_buffer.seek(0)
-    return base64.b64encode(image_buffer.read()).decode("utf-8")
+def _encode_image_bytes(image_bytes: bytes) -> bytes:
+    """Base64 encode raw image bytes for the API payload.
+
+    Returns ASCII bytes (not str) so they can be spliced into the JSON body as-is.
+    """
+    return _b64encode(image_bytes)
+
+# Serialized request skeleton; only the image data and the text part vary per call.
+# NOTE: The 'model_name' is handled by the URL in this client, so there is no
+# redundant 'config' block in the payload, which caused the 400 error.
+_PAYLOAD_TEMPLATE = (
+    b'{"contents":[{"role":"user","parts":['
+    b'{"inlineData":{"mimeType":"image/jpeg","data":"%b"}},'
+    b'{"text":%b}'
+    b']}]}'
+)
 
 def _make_gemini_payload(
-    base64_image: str,
+    base64_image: bytes,
     system_prompt: str,
     user_query: str,
     model_name: str
-) -> Dict[str, Any]:
-    """Constructs the API request payload for multimodal analysis.
-    
-    NOTE: The 'model_name' is handled by the URL in this client, so we do not
-    include a redundant 'config' block in the payload, which caused the 400 error.
+) -> bytes:
+    """Constructs the serialized JSON request body for multimodal analysis.
+
+    The base64 image is spliced straight into `_PAYLOAD_TEMPLATE` (base64 needs no
+    JSON escaping), so the multi-MB string is never walked by a JSON serializer.
+    Only the text prompt goes through `_json_dumps`.
     """
-    return {
-        "contents": [
-            {
-                "role": "user",
-                "parts": [
-                    # 1. Image Data
-                    {
-                        "inlineData": {
-                            "mimeType": "image/jpeg",
-                            "data": base64_image
-                        }
-                    },
-                    # 2. Text Prompt (System Instruction embedded in user message for clarity)
-                    { "text": f"SYSTEM INSTRUCTION: {system_prompt}\n\nUSER QUERY: {user_query}" }
-                ]
-            }
-        ]
-        # Removed the incorrect 'config' block which caused the API Error 400
-    }
+    # System Instruction embedded in user message for clarity
+    text = f"SYSTEM INSTRUCTION: {system_prompt}\n\nUSER QUERY: {user_query}"
+    return _PAYLOAD_TEMPLATE % (base64_image, _json_dumps(text))
+
+_IMAGE_PART_TEMPLATE = b'{"inlineData":{"mimeType":"image/jpeg","data":"%b"}}'
+
+# Structured output for batch requests: one {image_number, analysis} object per image
+_BATCH_GENERATION_CONFIG = {
+    "responseMimeType": "application/json",
+    "responseSchema": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "image_number": {"type": "INTEGER"},
+                "analysis": {"type": "STRING"},
+            },
+            "required": ["image_number", "analysis"],
+        },
+    },
+}
+
+def _make_gemini_batch_payload(
+    base64_images: List[bytes],
+    system_prompt: str,
+    user_query: str,
+) -> bytes:
+    """Constructs the serialized JSON request body for a multi-image request.
+
+    Each image part is preceded by an "Image N:" label so the model can refer to it,
+    and the response is constrained to `_BATCH_GENERATION_CONFIG`'s JSON array.
+    """
+    parts = []
+    for n, base64_image in enumerate(base64_images, start=1):
+        parts.append(b'{"text":' + _json_dumps(f"Image {n}:") + b'}')
+        parts.append(_IMAGE_PART_TEMPLATE % base64_image)
+    text = f"SYSTEM INSTRUCTION: {system_prompt}\n\nUSER QUERY: {user_query}"
+    parts.append(b'{"text":' + _json_dumps(text) + b'}')
+    return (
+        b'{"contents":[{"role":"user","parts":[' + b','.join(parts) + b']}],'
+        b'"generationConfig":' + _json_dumps(_BATCH_GENERATION_CONFIG) + b'}'
+    )
+
+def _extract_text_and_tokens(result: Dict[str, Any]) -> Tuple[str, int]:
+    """Pull the first candidate's text and the total token count out of a Gemini response."""
+    try:
+        text_content = result["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        text_content = ""
+
+    # Note: billing tokens might be different
+    try:
+        total_tokens = result["usageMetadata"]["totalTokenCount"]
+    except (KeyError, TypeError):
+        total_tokens = 0
+    return text_content, total_tokens
 
 
 # --- Client Class ---
 
 class GeminiClient:
-    """Client for direct interaction with the Gemini API for Vision tasks."""
+    """Client for direct interaction with the Gemini API for Vision tasks.
+
+    Holds no per-request state: payloads and results are built fresh for every
+    call, so one instance (and its connection pool) can be cached and shared
+    across Streamlit reruns and worker threads.
+    """
     
     # Use environment variables if not passed explicitly (typical for server deployment)
     _DEFAULT_API_URL = os.getenv("GEMINI_API_URL", "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent")
     
-    def __init__(self, api_key: Optional[str] = None, api_url: Optional[str] = None):
-        """Initializes the client with an API key and URL."""
+    # Transient statuses worth retrying; other 4xx errors are configuration problems
+    _RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        api_url: Optional[str] = None,
+        max_attempts: int = 3,
+        initial_backoff: float = 1.0,
+        requests_per_second: Optional[float] = None,
+        burst: int = 5,
+    ):
+        """Initializes the client with an API key and URL.
+
+        `max_attempts` and `initial_backoff` configure the retry policy of the
+        underlying connection pool: `initial_backoff` seconds before the first
+        retry, doubling per attempt (unless the server sends Retry-After).
+        `requests_per_second` enables a token-bucket limiter (bursts of `burst`
+        requests) shared by every call on this client; None means no throttling.
+        """
         self.api_key = api_key or os.getenv("GEMINI_API_KEY")
         self.api_url = api_url or self._DEFAULT_API_URL
 
         if not self.api_key:
             # Reraise a ValueError to be caught by app.py
             raise ValueError("API key must be provided or set as GEMINI_API_KEY environment variable.")
-        
 
-    def _call_gemini(self, payload: Dict[str, Any], timeout: int = 60) -> Dict[str, Any]:
-        """
-        Make a single HTTP POST request to the configured Gemini endpoint.
-        """
-        headers = {
+        # One persistent session so retries and subsequent images reuse the same
+        # keep-alive TLS connection instead of paying a new handshake per request.
+        self._session = requests.Session()
+        self._session.headers.update({
             "Content-Type": "application/json",
             # Use key in header as recommended for security
-            "x-goog-api-key": self.api_key 
-        }
+            "x-goog-api-key": self.api_key,
+        })
+        # Retries happen inside the connection pool, so they reuse the keep-alive socket
+        # and honour Retry-After. raise_on_status=False hands the last failed response
+        # back to _call_gemini, which turns it into an APIError with the response details.
+        retry = _BackoffRetry(
+            total=max_attempts - 1,
+            backoff_factor=initial_backoff,
+            status_forcelist=self._RETRY_STATUSES,
+            allowed_methods=frozenset({"POST"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+        # http:// too, for a GEMINI_API_URL pointing at a local proxy or emulator
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
 
-        full_url = self.api_url
-        
-        resp = requests.post(full_url, json=payload, headers=headers, timeout=timeout)
+        self._rate_limiter = _TokenBucket(requests_per_second, burst) if requests_per_second else None
+
+    def close(self) -> None:
+        """Close the underlying HTTP session and its pooled connections."""
+        self._session.close()
+
+    def __enter__(self) -> "GeminiClient":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def _call_gemini(self, body: Union[bytes, Dict[str, Any]], timeout: int = 60) -> Dict[str, Any]:
+        """
+        Make a single HTTP POST request to the configured Gemini endpoint.
+
+        `body` is normally the already-serialized JSON payload from
+        `_make_gemini_payload`; payloads that don't fit that template may be
+        passed as a dict and are serialized here with `_json_dumps`.
+        """
+        if not isinstance(body, bytes):
+            body = _json_dumps(body)
+        if self._rate_limiter is not None:
+            self._rate_limiter.acquire()
+        resp = self._session.post(self.api_url, data=body, timeout=timeout)
         
         try:
             resp.raise_for_status()
         except requests.HTTPError as e:
             # Provide context for logs
-            body = resp.text
+            details = resp.text
             status_code = resp.status_code
             # Check for common client-side configuration errors (4xx)
             if status_code in [400, 401, 403]:
-                 error_msg = f"Gemini API Error {status_code}: Check API Key or URL configuration. Details: {body}"
+                 error_msg = f"Gemini API Error {status_code}: Check API Key or URL configuration. Details: {details}"
             else:
-                 error_msg = f"Gemini API Error {status_code}. Details: {body}"
-            raise APIError(error_msg) from e
+                 error_msg = f"Gemini API Error {status_code}. Details: {details}"
+            raise APIError(error_msg, status=status_code) from e
 
         # Return JSON if possible
         try:
-            return resp.json()
+            return _json_loads(resp.content)
         except ValueError:
             raise APIError(f"Invalid JSON response from API: {resp.text}")
 
@@ -139,59 +318,191 @@ class GeminiClient:
     ) -> Dict[str, Any]:
         """
         Processes an image buffer and sends it to the Gemini model for analysis.
+
+        Thin wrapper around `analyze_image_from_bytes`, kept for callers that hold
+        a file-like object. `max_attempts`, `initial_backoff` and `backoff_multiplier`
+        are deprecated and ignored (a DeprecationWarning is emitted when they are set):
+        retries are now configured once, on the client
+        (`GeminiClient(max_attempts=..., initial_backoff=...)`).
         """
-        last_exc: Optional[Exception] = None
-        
+        if (max_attempts, initial_backoff, backoff_multiplier) != (3, 1.0, 2.0):
+            warnings.warn(
+                "analyze_image_from_buffer ignores max_attempts, initial_backoff and "
+                "backoff_multiplier; configure retries on GeminiClient instead.",
+                DeprecationWarning,
+                stacklevel=2,
+            )
         try:
-            base64_image = _encode_image_buffer(image_buffer)
+            image_buffer.seek(0)
+            image_bytes = image_buffer.read()
+        except Exception as e:
+            logger.error("Error reading image buffer: %s", e)
+            return {"success": False, "error": f"Image encoding failed: {str(e)}"}
+        return self.analyze_image_from_bytes(
+            image_bytes, model_name, system_prompt, user_query=user_query, timeout=timeout
+        )
+
+    def analyze_image_from_bytes(
+        self,
+        image_bytes: bytes,
+        model_name: str,
+        system_prompt: str,
+        user_query: str = "Analyze the image based on the system instruction and provide your structured response.",
+        timeout: int = 60,
+    ) -> Dict[str, Any]:
+        """
+        Sends raw JPEG bytes to the Gemini model for analysis.
+
+        Transient failures are retried by the session's Retry policy; by the time
+        `_call_gemini` raises, all attempts are exhausted. A successful (200) response
+        whose body is not valid JSON is not retried.
+        """
+        try:
+            base64_image = _encode_image_bytes(image_bytes)
         except Exception as e:
             logger.error("Error encoding image: %s", e)
             return {"success": False, "error": f"Image encoding failed: {str(e)}"}
             
         # Call the corrected payload function
-        payload = _make_gemini_payload(base64_image, system_prompt, user_query, model_name)
-
-        for attempt in range(1, max_attempts + 1):
-            try:
-                logger.info("Gemini attempt %d/%d (Model: %s)", attempt, max_attempts, model_name)
-                
-                # Make the API call
-                result = self._call_gemini(payload, timeout=timeout)
-                logger.info("Gemini success on attempt %d", attempt)
-
-                # Extract content from the specific Gemini response structure
-                text_content = result.get('candidates', [{}])[0].get('content', {}).get('parts', [{}])[0].get('text', '')
-                
-                # Extract token usage (note: billing tokens might be different)
-                usage_metadata = result.get('usageMetadata', {})
-                total_tokens = usage_metadata.get('totalTokenCount', 0)
-
-                return {
+        body = _make_gemini_payload(base64_image, system_prompt, user_query, model_name)
+
+        try:
+            logger.info("Gemini request (Model: %s)", model_name)
+            result = self._call_gemini(body, timeout=timeout)
+        except (requests.RequestException, APIError) as e:
+            logger.error("Gemini request failed: %s", e)
+            return {"success": False, "error": f"Request failed: {e}", "model_used": model_name}
+        logger.info("Gemini success (Model: %s)", model_name)
+
+        # Extract content and token usage from the specific Gemini response structure
+        text_content, total_tokens = _extract_text_and_tokens(result)
+
+        return {
+            "success": True,
+            "analysis": text_content,
+            "model_used": model_name,
+            "tokens_used": total_tokens,
+        }
+
+    def analyze_many(
+        self,
+        images: List[bytes],
+        model_name: str,
+        system_prompt: str,
+        max_workers: int = 5,
+        **kwargs: Any,
+    ) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Analyzes several images (raw JPEG bytes) concurrently and yields `(index, result)`
+        pairs in completion order, so callers can report progress as each image finishes.
+
+        The calls are network-bound and share the pooled session, so a small thread
+        pool brings batch latency close to that of the slowest single image.
+        Extra keyword arguments are forwarded to `analyze_image_from_bytes`.
+        """
+        if not images:
+            return
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(images))) as executor:
+            futures = {
+                executor.submit(self.analyze_image_from_bytes, image, model_name, system_prompt, **kwargs): i
+                for i, image in enumerate(images)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error("Gemini analysis of image %d raised: %s", i + 1, e)
+                    result = {"success": False, "error": str(e), "model_used": model_name}
+                yield i, result
+
+    def analyze_images_batch(
+        self,
+        images: List[bytes],
+        model_name: str,
+        system_prompt: str,
+        user_query: Optional[str] = None,
+        timeout: int = 120,
+    ) -> List[Dict[str, Any]]:
+        """
+        Analyzes several images (raw JPEG bytes) in a single multi-image request.
+
+        The model is asked for a JSON array with one analysis per image, which is
+        mapped back to one result dict per input, in input order. The reported token
+        counts split the request total across the answered images and add up to it.
+        If the request fails, or an image is missing from the response, the affected entries are
+        failure results carrying a `retryable` flag: True when sending the images
+        one by one could help (unparseable reply, missing image, 5xx or connection
+        error), False when it cannot or would only add load (4xx, including 429).
+        """
+        if not images:
+            return []
+        if user_query is None:
+            user_query = (
+                f"Analyze each of the {len(images)} images above independently, based on the system "
+                "instruction. Respond with a JSON array containing one object per image, with its "
+                "image_number and your full structured response as Markdown text in analysis."
+            )
+
+        try:
+            body = _make_gemini_batch_payload(
+                [_encode_image_bytes(image) for image in images], system_prompt, user_query
+            )
+        except Exception as e:
+            logger.error("Error encoding images: %s", e)
+            return [
+                {"success": False, "error": f"Image encoding failed: {str(e)}", "retryable": False}
+                for _ in images
+            ]
+
+        try:
+            logger.info("Gemini batch request for %d images (Model: %s)", len(images), model_name)
+            result = self._call_gemini(body, timeout=timeout)
+            text_content, total_tokens = _extract_text_and_tokens(result)
+            analyses = {
+                int(item["image_number"]): item["analysis"]
+                for item in _json_loads(text_content)
+            }
+        except (requests.RequestException, APIError) as e:
+            logger.error("Gemini batch request failed: %s", e)
+            # An APIError without a status is an unparseable reply body
+            retryable = not isinstance(e, APIError) or e.status is None or e.status >= 500
+            return [
+                {"success": False, "error": f"Request failed: {e}", "model_used": model_name,
+                 "retryable": retryable}
+                for _ in images
+            ]
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error("Unexpected Gemini batch response: %s", e)
+            return [
+                {"success": False, "error": f"Unexpected batch response: {e}", "model_used": model_name,
+                 "retryable": True}
+                for _ in images
+            ]
+        logger.info("Gemini batch success (Model: %s)", model_name)
+
+        # Billed tokens are split across the answered images; the first ones take the
+        # remainder, so the per-image counts add up to the request total
+        answered = sum(1 for n in range(1, len(images) + 1) if n in analyses)
+        tokens_per_image, remainder = divmod(total_tokens, answered or 1)
+        results = []
+        for n in range(1, len(images) + 1):
+            if n in analyses:
+                results.append({
                     "success": True,
-                    "analysis": text_content,
+                    "analysis": analyses[n],
+                    "model_used": model_name,
+                    "tokens_used": tokens_per_image + (1 if remainder > 0 else 0),
+                })
+                remainder -= 1
+            else:
+                results.append({
+                    "success": False,
+                    "error": f"Batch response had no analysis for image {n}",
                     "model_used": model_name,
-                    "tokens_used": total_tokens,
-                }
-                
-            except (requests.RequestException, APIError) as e:
-                last_exc = e
-                logger.warning("Gemini attempt %d failed: %s", attempt, str(e))
-                
-                # Decide whether to retry: do not retry on client errors (4xx) unless 429
-                if isinstance(e, APIError) and "API Error 4" in str(e) and "429" not in str(e):
-                    logger.error("Client error encountered; not retrying further.")
-                    break
-
-                if attempt < max_attempts:
-                    backoff = initial_backoff * (backoff_multiplier ** (attempt - 1))
-                    logger.info("Retrying after %.1f seconds...", backoff)
-                    time.sleep(backoff)
-                else:
-                    logger.error("Gemini failed after %d attempts", max_attempts)
-
-        # If we reach here, all attempts failed
-        error_message = f"All attempts failed. Last error: {last_exc}"
-        return {"success": False, "error": error_message, "model_used": model_name}
+                    "retryable": True,
+                })
+        return results
 
 
 if __name__ == "__main__":
@@ -1,10 +1,15 @@
-import streamlit as st
-import time
-from PIL import Image
-import pandas as pd
+import hashlib
 import io
 import os
 import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+import xlsxwriter
+from PIL import Image, ImageOps
 
 # Import the newly defined GeminiClient
 from api_client import GeminiClient, APIError
@@ -18,20 +23,11 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# CSS + style
-st.markdown(
-    """
+# CSS + style, kept as one module-level constant so nothing is rebuilt per rerun.
+# Page colours come from the theme in .streamlit/config.toml; only what the theme
+# can't express (button/badge styling) lives here.
+APP_CSS = """
     <style>
-    body {
-        background: linear-gradient(120deg, #ff9a9e, #fad0c4, #fbc2eb, #a18cd1);
-        background-size: 300% 300%;
-        animation: gradientMove 10s ease infinite;
-    }
-    @keyframes gradientMove {
-        0% {background-position: 0% 50%;}
-        50% {background-position: 100% 50%;}
-        100% {background-position: 0% 50%;}
-    }
     .stButton>button {
         background-color: #ff6f91;
         color: white;
@@ -57,9 +53,14 @@ st.markdown(
         100% { transform: scale(1); filter:brightness(1); }
     }
     </style>
-    """,
-    unsafe_allow_html=True
-)
+"""
+
+@st.cache_resource
+def inject_css():
+    # Streamlit replays the cached element on later reruns instead of re-running the call
+    st.markdown(APP_CSS, unsafe_allow_html=True)
+
+inject_css()
 
 def initialize_session_state():
     if 'analysis_results' not in st.session_state:
@@ -72,67 +73,225 @@ def initialize_session_state():
         st.session_state.show_settings_modal = False
     if 'settings_unlocked' not in st.session_state:
         st.session_state.settings_unlocked = False
+    if 'upload_fingerprint' not in st.session_state:
+        st.session_state.upload_fingerprint = None
+    if 'pending_uploads' not in st.session_state:
+        st.session_state.pending_uploads = []
+
+@st.cache_resource
+def get_client(api_key: str) -> GeminiClient:
+    """Build one GeminiClient per API key and keep it (and its connection pool) across reruns.
+
+    The client's token bucket is shared by every session using the key, so the
+    quota is respected as a whole; it only delays calls once the burst is used up.
+    """
+    return GeminiClient(
+        api_key=api_key,
+        requests_per_second=GEMINI_REQUESTS_PER_MINUTE / 60,
+        burst=MAX_CONCURRENT_REQUESTS,
+    )
+
+# Successful analyses kept across reruns and sessions, keyed by (image digest, model, task type)
+ANALYSIS_CACHE_SIZE = 256
+
+@st.cache_resource
+def get_analysis_cache():
+    """Shared result cache and the lock guarding it; only successful analyses are stored,
+    oldest evicted first. Sessions run their scripts on separate threads."""
+    return OrderedDict(), threading.Lock()
+
+def get_cached_analysis(key):
+    cache, lock = get_analysis_cache()
+    with lock:
+        return cache.get(key)
+
+def store_analysis(key, result):
+    cache, lock = get_analysis_cache()
+    with lock:
+        cache[key] = result
+        while len(cache) > ANALYSIS_CACHE_SIZE:
+            cache.popitem(last=False)
+
+# Longest side sent to Gemini Vision, which tiles inputs at ~768px; larger images
+# only add upload bytes, encode time and billed tiles
+MAX_IMAGE_SIDE = 1024
+# Longest side of the preview shown next to each analysis
+THUMBNAIL_SIDE = 512
+# Gemini calls in flight at once during a batch (politeness bound for rate limits)
+MAX_CONCURRENT_REQUESTS = 5
+# Gemini request quota per API key (override with GEMINI_RPM to match your tier)
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_RPM", "60"))
+# Analyses shown per page in the results section
+RESULTS_PER_PAGE = 5
 
-def process_uploaded_image(uploaded_file):
-    try:
-        img = Image.open(uploaded_file)
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='JPEG', quality=95)
-        img_buffer.seek(0)
-        return img_buffer, img.size
-    except Exception as e:
-        st.error(f"Error processing image {getattr(uploaded_file, 'name', '')}: {str(e)}")
-        return None, None
-
-def display_image_with_analysis(uploaded_file, image_size, analysis_result, index):
+def make_thumbnail(img):
+    # Modifies img (draft/thumbnail); pass a copy if the caller still needs it
+    img.draft('RGB', (THUMBNAIL_SIDE, THUMBNAIL_SIDE))
+    # The re-encoded preview has no EXIF, so apply the camera's orientation to the pixels
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE))
+    thumb_buffer = io.BytesIO()
+    img.save(thumb_buffer, format='JPEG', quality=75)
+    return thumb_buffer.getvalue()
+
+def image_digest(data):
+    # BLAKE2b is faster than SHA-256 and plenty for telling images apart
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+# Processed uploads kept across reruns; the cache is shared by every session
+PROCESSED_IMAGE_CACHE_SIZE = 64
+
+@st.cache_data(show_spinner=False, max_entries=PROCESSED_IMAGE_CACHE_SIZE)
+def process_uploaded_image(raw):
+    # Cached on the upload's bytes, so reruns reuse the processed image instead of
+    # decoding/re-encoding again. Runs on worker threads during ingestion, so no
+    # Streamlit UI calls here: errors propagate to the caller, which reports them
+    # on the script thread (and failures are not cached).
+    img = Image.open(io.BytesIO(raw))
+    # Original dimensions are what the UI reports, even if the upload is downscaled
+    original_size = img.size
+    # Small RGB JPEG uploads are already what the API wants: they are sent as-is and
+    # only decoded (at reduced scale) for the preview thumbnail. The format comes from
+    # the file itself: the browser's MIME type only reflects the file extension.
+    if img.format == 'JPEG' and img.mode == 'RGB' and max(original_size) <= MAX_IMAGE_SIDE:
+        return raw, original_size, make_thumbnail(img), image_digest(raw)
+    # For JPEGs, let libjpeg decode at a reduced DCT scale (1/2, 1/4, 1/8). The draft never
+    # goes below the requested size (a 4000x3000 photo decodes at 2000x1500), which leaves
+    # the LANCZOS resize its headroom; no-op for other formats
+    img.draft('RGB', (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+    # Likewise the re-encoded upload: rotate portrait phone photos upright before saving
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    # Pillow's JPEG save never copies EXIF or ICC from the source unless passed explicitly,
+    # but it does carry over a JPEG comment (COM marker) from img.info; drop that too
+    img.info = {}
+    if max(img.size) > MAX_IMAGE_SIDE:
+        img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='JPEG', quality=85, optimize=True, progressive=True, subsampling=2)
+    img_bytes = img_buffer.getvalue()
+    return img_bytes, original_size, make_thumbnail(img.copy()), image_digest(img_bytes)
+
+@st.cache_resource
+def get_ingest_executor():
+    # Shared pool for upload processing. Pillow releases the GIL while decoding/encoding,
+    # so uploads are processed in parallel, and in the background while the page renders.
+    return ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+
+def collect_ingested_files(wait):
+    # Moves finished upload processing into st.session_state.uploaded_files and returns how
+    # many images are ready. Without wait, nothing is collected until every upload is done.
+    pending = st.session_state.pending_uploads
+    if pending and (wait or all(future.done() for _, future in pending)):
+        st.session_state.pending_uploads = []
+        for name, future in pending:
+            try:
+                img_bytes, img_size, thumb_bytes, digest = future.result()
+            except Exception as e:
+                st.error(f"Error processing image {name}: {str(e)}")
+                continue
+            st.session_state.uploaded_files.append({
+                "name": name,
+                "data": img_bytes,
+                "digest": digest,
+                "size": img_size,
+                "caption": f"Size: {img_size[0]}x{img_size[1]} pixels",
+                "thumb": thumb_bytes
+            })
+    return len(st.session_state.uploaded_files)
+
+def display_image_with_analysis(thumbnail, size_caption, analysis_result, index):
+    # Captions are formatted once (at ingestion / analysis time), not on every rerun
     col1, col2 = st.columns([1, 2])
     with col1:
-        st.image(uploaded_file, caption=f"Image {index + 1}", use_column_width=True)
-        if image_size:
-            st.caption(f"Size: {image_size[0]}x{image_size[1]} pixels")
+        st.image(thumbnail, caption=f"Image {index + 1}", use_column_width=True)
+        if size_caption:
+            st.caption(size_caption)
     with col2:
         if analysis_result.get("success"):
             st.success(f"✅ Analysis Complete (Model: {analysis_result['model_used']})")
             with st.expander("📋 Full Analysis", expanded=True):
                 st.markdown(analysis_result["analysis"])
-            if analysis_result.get("tokens_used"):
-                st.caption(f"Tokens used: {analysis_result['tokens_used']}")
+            if analysis_result.get("token_caption"):
+                st.caption(analysis_result["token_caption"])
         elif analysis_result.get("error"):
             st.error(f"❌ Analysis Failed: {analysis_result['error']}")
         else:
             st.info("⏳ Analysis pending...")
 
-def export_results_to_excel():
-    if not st.session_state.analysis_results:
+EXCEL_HEADERS = ("Image Number", "Image Name", "Model Used", "Analysis", "Tokens Used", "Timestamp")
+
+def export_results_to_excel(rows):
+    # rows: any iterable of tuples in EXCEL_HEADERS order (one per successful analysis).
+    # Each row is written as it is produced; constant_memory flushes rows as it goes.
+    excel_buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(excel_buffer, {"constant_memory": True, "in_memory": True})
+    worksheet = workbook.add_worksheet("Analysis Results")
+    worksheet.write_row(0, 0, EXCEL_HEADERS)
+    row_count = 0
+    for row_count, row in enumerate(rows, start=1):
+        worksheet.write_row(row_count, 0, row)
+    workbook.close()
+    if not row_count:
         st.warning("No results to export!")
         return
+    st.download_button(
+        label="📥 Download Results as Excel",
+        data=excel_buffer.getvalue(),
+        file_name=f"cattle_analysis_results_{int(time.time())}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+@st.fragment
+def render_results():
+    # A fragment: interacting with widgets in here (e.g. the download button) reruns
+    # only this block, not the whole script. One pass renders each result while
+    # tallying the metrics and collecting the export rows; the summary is filled in
+    # above the results afterwards.
+    summary = st.container()
+    st.divider()
+    # Only one page of results is built per run; switching pages reruns just this fragment
+    page_count = -(-len(st.session_state.analysis_results) // RESULTS_PER_PAGE)
+    page = 1
+    if page_count > 1:
+        page = st.selectbox("Results page", range(1, page_count + 1),
+                            format_func=lambda p: f"Page {p} of {page_count}")
+    first_index = (page - 1) * RESULTS_PER_PAGE
+    last_index = min(first_index + RESULTS_PER_PAGE, len(st.session_state.analysis_results)) - 1
+    successful_analyses = failed_analyses = 0
     excel_data = []
-    for i, result in enumerate(st.session_state.analysis_results):
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    for i, (file_info, result) in enumerate(zip(st.session_state.uploaded_files, st.session_state.analysis_results)):
         if result.get("success"):
-            excel_data.append({
-                "Image Number": i + 1,
-                "Image Name": st.session_state.uploaded_files[i]["name"],
-                "Model Used": result["model_used"],
-                "Analysis": result["analysis"],
-                "Tokens Used": result.get("tokens_used", 0),
-                "Timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-            })
-    if excel_data:
-        df = pd.DataFrame(excel_data)
-        excel_buffer = io.BytesIO()
-        with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name='Analysis Results')
-        st.download_button(
-            label="📥 Download Results as Excel",
-            data=excel_buffer.getvalue(),
-            file_name=f"cattle_analysis_results_{int(time.time())}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-
-# small placeholder beep bytes (still OK to keep)
-BEEP_WAV = b'RIFF$\x00\x00\x00WAVEfmt ' + b'\x10\x00\x00\x00' + b'\x01\x00\x01\x00' + b'\x40\x1f\x00\x00' + b'\x80>\x00\x00' + b'\x02\x00\x10\x00' + b'data\x00\x00\x00\x00'
+            successful_analyses += 1
+            excel_data.append((
+                i + 1,
+                file_info["name"],
+                result["model_used"],
+                result["analysis"],
+                result.get("tokens_used", 0),
+                timestamp
+            ))
+        elif result.get("error"):
+            failed_analyses += 1
+        if first_index <= i <= last_index:
+            display_image_with_analysis(file_info["thumb"], file_info["caption"], result, i)
+            if i < last_index:
+                st.divider()
+    with summary:
+        c1, c2, c3 = st.columns(3)
+        c1.metric("✅ Successful", successful_analyses)
+        c2.metric("❌ Failed", failed_analyses)
+        c3.metric("📊 Total", len(st.session_state.uploaded_files))
+        if successful_analyses > 0:
+            export_results_to_excel(excel_data)
+
+# small placeholder beep bytes (still OK to keep): a 44-byte WAV header with an empty
+# data chunk, as one literal (8 kHz, mono, 16-bit PCM)
+BEEP_WAV = b'RIFF$\x00\x00\x00WAVEfmt \x10\x00\x00\x00\x01\x00\x01\x00@\x1f\x00\x00\x80>\x00\x00\x02\x00\x10\x00data\x00\x00\x00\x00'
 
 def main():
     initialize_session_state()
@@ -197,7 +356,7 @@ def main():
                 if pwd == "letmein123":
                     st.session_state.settings_unlocked = True
                     st.session_state.show_settings_modal = False
-                    st.experimental_rerun()
+                    st.rerun()
                 else:
                     st.error("Incorrect password.")
         st.markdown('</div></div>', unsafe_allow_html=True)
@@ -239,56 +398,102 @@ def main():
         if len(uploaded_files) > 10:
             st.warning("⚠️ Maximum 10 images allowed. Only the first 10 will be processed.")
             uploaded_files = uploaded_files[:10]
-        st.session_state.analysis_results = []
-        st.session_state.uploaded_files = []
-        for uploaded_file in uploaded_files:
-            img_buffer, img_size = process_uploaded_image(uploaded_file)
-            if img_buffer:
-                st.session_state.uploaded_files.append({
-                    "name": uploaded_file.name,
-                    "buffer": img_buffer,
-                    "size": img_size,
-                    "original_file": uploaded_file
-                })
+        # Only (re)process when the set of uploads actually changed; otherwise keep the
+        # processed images and any analysis results from earlier reruns
+        fingerprint = tuple((f.file_id, f.name, f.size) for f in uploaded_files)
+        if fingerprint != st.session_state.upload_fingerprint:
+            st.session_state.upload_fingerprint = fingerprint
+            st.session_state.analysis_results = []
+            st.session_state.uploaded_files = []
+            # Processing starts now and runs in the background; it is collected once done,
+            # or at the latest when the user asks for the analysis
+            executor = get_ingest_executor()
+            st.session_state.pending_uploads = [
+                (uploaded_file.name, executor.submit(process_uploaded_image, uploaded_file.getvalue()))
+                for uploaded_file in uploaded_files
+            ]
 
     # Analysis UI
     st.header("🔬 Analysis Results")
-    total_files = len(st.session_state.uploaded_files)
+    collect_ingested_files(wait=False)
+    total_files = len(st.session_state.uploaded_files) + len(st.session_state.pending_uploads)
     if total_files == 0:
         st.info("Upload images to begin.")
     else:
-        if st.button("🚀 Analyze All Images", use_container_width=True):
+        if st.button("🚀 Analyze All Images", use_container_width=True) and collect_ingested_files(wait=True):
+            total_files = len(st.session_state.uploaded_files)
             progress_bar = st.progress(0)
             status_text = st.empty()
-            st.session_state.analysis_results = []
             # Create a dummy client in demo mode or real client if API available
             client = None
             if not demo_mode and api_key:
-                client = GeminiClient(api_key=api_key)
-            for i, file_info in enumerate(st.session_state.uploaded_files):
-                status_text.text(f"Analyzing image {i+1}/{total_files}: {file_info['name']}")
-                # Demo result or real call
-                if demo_mode or client is None:
-                    # Simulated response structure
-                    result = {
+                client = get_client(api_key)
+            if demo_mode or client is None:
+                # Simulated response structure, built in one go (no per-image UI updates)
+                st.session_state.analysis_results = [
+                    {
                         "success": True,
                         "model_used": selected_model,
                         "analysis": f"Simulated analysis for {file_info['name']} (task: {st.session_state.task_type})",
                         "tokens_used": random.randint(10, 50)
                     }
-                else:
-                    # Real API call example (ensure client supports this method)
-                    try:
-                        result = client.analyze_image_from_buffer(
-                            image_buffer=file_info["buffer"],
+                    for file_info in st.session_state.uploaded_files
+                ]
+            else:
+                # Previously analyzed images are served from the cache; the rest go to
+                # Gemini together in one multi-image request and are slotted back into upload order
+                system_prompt = get_system_prompt(st.session_state.task_type)
+                results = [None] * total_files
+                # Uncached upload indices grouped by image digest, so duplicate uploads
+                # are sent (and billed) only once
+                pending = {}
+                for i, file_info in enumerate(st.session_state.uploaded_files):
+                    cached = get_cached_analysis((file_info["digest"], selected_model, st.session_state.task_type))
+                    if cached is not None:
+                        results[i] = cached
+                    else:
+                        pending.setdefault(file_info["digest"], []).append(i)
+                if pending:
+                    pending_items = list(pending.items())
+                    progress_bar.progress((total_files - results.count(None)) / total_files)
+                    status_text.text(f"Analyzing {len(pending_items)} image(s) in one request...")
+                    batch_results = client.analyze_images_batch(
+                        [st.session_state.uploaded_files[indices[0]]["data"] for _, indices in pending_items],
+                        model_name=selected_model,
+                        system_prompt=system_prompt
+                    )
+                    failed = []
+                    for n, ((digest, indices), result) in enumerate(zip(pending_items, batch_results)):
+                        if result.get("retryable"):
+                            failed.append(n)
+                            continue
+                        for i in indices:
+                            results[i] = result
+                        if result.get("success"):
+                            store_analysis((digest, selected_model, st.session_state.task_type), result)
+                    # Images the batch could not answer for transient reasons (unparseable reply,
+                    # image left out, 5xx or connection error) are retried one request per image,
+                    # concurrently. 4xx failures (bad key, quota exhausted) are shown as-is:
+                    # retrying cannot fix them and would only add load.
+                    if failed:
+                        progress_bar.progress((total_files - sum(len(pending_items[n][1]) for n in failed)) / total_files)
+                        status_text.text(f"Retrying {len(failed)} image(s) individually...")
+                        for j, result in client.analyze_many(
+                            [st.session_state.uploaded_files[pending_items[n][1][0]]["data"] for n in failed],
                             model_name=selected_model,
-                            system_prompt=get_system_prompt(st.session_state.task_type)
-                        )
-                    except Exception as e:
-                        result = {"success": False, "error": str(e)}
-                st.session_state.analysis_results.append(result)
-                progress_bar.progress((i + 1) / total_files)
-                time.sleep(0.5)
+                            system_prompt=system_prompt,
+                            max_workers=MAX_CONCURRENT_REQUESTS
+                        ):
+                            digest, indices = pending_items[failed[j]]
+                            for i in indices:
+                                results[i] = result
+                            if result.get("success"):
+                                store_analysis((digest, selected_model, st.session_state.task_type), result)
+                            progress_bar.progress((total_files - results.count(None)) / total_files)
+                st.session_state.analysis_results = results
+            for result in st.session_state.analysis_results:
+                if result.get("tokens_used"):
+                    result["token_caption"] = f"Tokens used: {result['tokens_used']}"
             status_text.text("✅ All analyses complete!")
             progress_bar.progress(1.0)
             time.sleep(0.6)
@@ -315,19 +520,7 @@ def main():
 
         # show summary + results
         if st.session_state.analysis_results:
-            successful_analyses = len([r for r in st.session_state.analysis_results if r.get("success")])
-            failed_analyses = len([r for r in st.session_state.analysis_results if r.get("error")])
-            c1, c2, c3 = st.columns(3)
-            c1.metric("✅ Successful", successful_analyses)
-            c2.metric("❌ Failed", failed_analyses)
-            c3.metric("📊 Total", len(st.session_state.uploaded_files))
-            if successful_analyses > 0:
-                export_results_to_excel()
-            st.divider()
-            for i, (file_info, result) in enumerate(zip(st.session_state.uploaded_files, st.session_state.analysis_results)):
-                display_image_with_analysis(file_info["original_file"], file_info["size"], result, i)
-                if i < len(st.session_state.uploaded_files) - 1:
-                    st.divider()
+            render_results()
 
     # Footer
     st.divider()
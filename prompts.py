@@ -2,6 +2,8 @@
 System prompts for cattle and buffalo analysis
 """
 
+from functools import lru_cache
+
 BREED_RECOGNITION_PROMPT = """
 You are an expert veterinarian and cattle/buffalo breed specialist with extensive knowledge of Indian indigenous and crossbred cattle and buffalo breeds. 
 
@@ -61,6 +63,7 @@ Your task is to analyze the provided image and evaluate the animal's physical tr
 Provide detailed reasoning for each assessment based on visible physical characteristics in the image.
 """
 
+@lru_cache(maxsize=8)
 def get_system_prompt(task_type):
     """Get the appropriate system prompt based on task type"""
     if task_type == "breed_recognition":